@@ -1,14 +1,116 @@
 import os
+import re
+import asyncio
+import hashlib
 import subprocess
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import numpy as np
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from pydantic import BaseModel
 
 # === CONFIG ===
-client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+# One shared client so every request reuses the same pooled HTTP/2 connection
+client = genai.Client(
+    api_key=os.environ["GEMINI_API_KEY"],
+    http_options=types.HttpOptions(async_client_args={"http2": True}),
+)
 DOCS_REPO_URL = os.environ["DOCS_REPO_URL"]
 BRANCH_NAME = "doc-update-from-pr"
+# Cheap model for the relevance filter, more capable one for writing doc updates
+SELECTION_MODEL = os.environ.get("SELECTION_MODEL", "gemini-2.5-flash-lite")
+AUTHOR_MODEL = os.environ.get("AUTHOR_MODEL", "gemini-2.5-flash")
+# Gemini 2.5 Flash and Flash-Lite accept 1M input tokens; leave headroom for the prompt and output
+MAX_BATCH_TOKENS = 800_000
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARKER = "\n[...truncated...]\n"
+DOC_EXTENSIONS = (".adoc", ".md")
+IGNORED_DIRS = {".git", "node_modules"}
+MAX_CONCURRENT_REQUESTS = 8
+GEMINI_ATTEMPTS = 4
+# Per-minute quotas need a much longer wait than transient network or server errors
+RATE_LIMIT_BACKOFF_SECONDS = 30
+gemini_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+# Gemini rejects context caches below a minimum size, so small diffs are sent inline
+MIN_CACHE_TOKENS = 2048
+DIFF_CACHE_TTL = "600s"
+# Embedding pre-filter that drops obviously unrelated docs before the relevance prompts
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "gemini-embedding-001")
+EMBEDDING_BATCH_SIZE = 100
+EMBEDDING_MAX_CHARS = 8000
+SIMILARITY_THRESHOLD = float(os.environ.get("SIMILARITY_THRESHOLD", "0.3"))
+# Resolved up front because the script later changes into the docs directory
+EMBEDDING_CACHE_DIR = Path(os.environ.get("EMBEDDING_CACHE_DIR", ".doc_embedding_cache")).resolve()
+UPDATE_CACHE_DIR = Path(os.environ.get("UPDATE_CACHE_DIR", ".doc_update_cache")).resolve()
+# Docs selected with at least this confidence get a prompt that expects an update
+HIGH_CONFIDENCE = float(os.environ.get("HIGH_CONFIDENCE", "0.9"))
+
+class FileRelevance(BaseModel):
+    """Structured verdict returned by the relevance step for a single doc file"""
+    file: str
+    confidence: float
+    likely_needs_edit: bool
+
+def _run(cmd, capture=False, check=True, **kwargs):
+    """Run a command, only opening pipes when its output is needed, and fail loudly by default"""
+    result = subprocess.run(cmd, capture_output=capture, text=True, **kwargs)
+    if check and result.returncode != 0:
+        # Report only the program and subcommand so authenticated URLs never reach the logs
+        raise subprocess.CalledProcessError(result.returncode, cmd[:2], result.stdout, result.stderr)
+    return result
+
+def split_diff_by_file(diff):
+    """Split a unified diff into {path: per-file diff text} using its `diff --git` headers"""
+    diff_by_file = {}
+    path = None
+    lines = []
+    for line in diff.splitlines(keepends=True):
+        if line.startswith("diff --git a/"):
+            if path is not None:
+                diff_by_file[path] = "".join(lines)
+            path = line.rstrip("\n").split(" b/", 1)[-1]
+            lines = []
+        lines.append(line)
+    if path is not None:
+        diff_by_file[path] = "".join(lines)
+    return diff_by_file
+
+def summarize_diff(diff_by_file):
+    """Compact view of a diff for the relevance step: file names plus hunk headers only"""
+    outline = []
+    for path, file_diff in diff_by_file.items():
+        outline.append(f"File: {path}")
+        outline.extend(line for line in file_diff.splitlines() if line.startswith("@@"))
+    return "\n".join(outline)
+
+def _mentions(text, token):
+    """True if token appears in text as a whole file name or path, not inside a longer name"""
+    return re.search(rf"(?<![\w.-]){re.escape(token)}(?![\w-])", text) is not None
+
+def _mentions_word(text, word):
+    """True if word appears in text on its own, not inside a longer word ("main" vs "maintaining")"""
+    return re.search(rf"(?<![\w-]){re.escape(word)}(?![\w-])", text) is not None
+
+def select_diff_for_doc(diff, diff_by_file, doc_content):
+    """Return only the per-file diffs of source files the doc explicitly names, or the full diff"""
+    doc_text = doc_content.lower()
+    matched = []
+    for path, file_diff in diff_by_file.items():
+        name = os.path.basename(path).lower()
+        stem = os.path.splitext(name)[0]
+        if _mentions(doc_text, path.lower()) or _mentions(doc_text, name):
+            matched.append(file_diff)
+        elif len(stem) >= 3 and _mentions_word(doc_text, stem):
+            # A bare stem ("config", "main", "cli") is too generic to tell whether the
+            # doc is about this file, so the mapping is uncertain
+            return diff
+
+    # Mapping is uncertain when nothing or everything matches - fall back to the full diff
+    if not matched or len(matched) == len(diff_by_file):
+        return diff
+    return "".join(matched).strip()
 
 def get_diff():
     """Get the full diff for the entire PR, not just the latest commit"""
@@ -18,43 +120,17 @@ def get_diff():
     
     print(f"Getting diff for PR #{pr_number} against base: {pr_base}")
     
-    # Get the merge-base to ensure we capture all PR changes
-    merge_base_result = subprocess.run(
-        ["git", "merge-base", pr_base, "HEAD"], 
-        capture_output=True, text=True
-    )
-    
-    if merge_base_result.returncode == 0:
-        # Use merge-base to get all changes in the PR branch
-        merge_base = merge_base_result.stdout.strip()
-        print(f"Using merge-base: {merge_base[:7]}...{merge_base[-7:]}")
-        
-        # Show which files changed in the entire PR
-        files_result = subprocess.run(
-            ["git", "diff", "--name-only", f"{merge_base}...HEAD"], 
-            capture_output=True, text=True
-        )
-        if files_result.returncode == 0:
-            changed_files = files_result.stdout.strip().split('\n')
-            changed_files = [f for f in changed_files if f.strip()]
-            print(f"Files changed in entire PR: {changed_files}")
-        
-        result = subprocess.run(
-            ["git", "diff", f"{merge_base}...HEAD"], 
-            capture_output=True, text=True
-        )
-        diff_method = f"merge-base ({merge_base[:7]}...HEAD)"
-    else:
-        # Fallback to the original method
-        print("Warning: Could not find merge-base, using fallback diff method")
-        result = subprocess.run(
-            ["git", "diff", f"{pr_base}...HEAD"], 
-            capture_output=True, text=True
-        )
-        diff_method = f"direct ({pr_base}...HEAD)"
+    # The three-dot form diffs HEAD against its merge-base with the PR base,
+    # so a single git process captures all PR changes
+    result = _run(["git", "diff", f"{pr_base}...HEAD"], capture=True, check=False)
+    if result.returncode != 0:
+        print(f"Warning: Could not diff against {pr_base}: {result.stderr.strip()}")
+        return ""
     
     diff_content = result.stdout.strip()
-    print(f"Diff method: {diff_method}")
+    # Show which files changed in the entire PR
+    print(f"Files changed in entire PR: {list(split_diff_by_file(diff_content))}")
+    print(f"Diff method: merge-base ({pr_base}...HEAD)")
     print(f"Diff size: {len(diff_content)} characters")
     
     return diff_content
@@ -66,14 +142,22 @@ def get_commit_info():
         pr_number = os.environ.get("PR_NUMBER")
         print(f"Debug: PR_NUMBER from environment: '{pr_number}'")
         
-        # Get the HEAD commit - this is what GitHub Actions checked out for the PR
-        current_commit_result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True)
+        # Get the HEAD commit (what GitHub Actions checked out for the PR) and the
+        # remote origin URL (to construct proper commit links) concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            current_commit_future = executor.submit(
+                _run, ["git", "rev-parse", "HEAD"], capture=True, check=False
+            )
+            remote_url_future = executor.submit(
+                _run, ["git", "config", "--get", "remote.origin.url"], capture=True, check=False
+            )
+            current_commit_result = current_commit_future.result()
+            remote_url = remote_url_future.result()
+
         if current_commit_result.returncode != 0:
             return None
         commit_hash = current_commit_result.stdout.strip()
         
-        # Get remote origin URL to construct proper commit links
-        remote_url = subprocess.run(["git", "config", "--get", "remote.origin.url"], capture_output=True, text=True)
         if remote_url.returncode != 0:
             return None
         
@@ -134,145 +218,311 @@ def setup_docs_environment():
     else:
         # Clone separate repository (existing behavior)
         print("Cloning separate docs repository")
-        subprocess.run(["git", "clone", DOCS_REPO_URL, "docs_repo"])
+        _run(["git", "clone", DOCS_REPO_URL, "docs_repo"])
         os.chdir("docs_repo")
 
         # Try to check out the branch if it already exists
-        result = subprocess.run(["git", "ls-remote", "--heads", "origin", BRANCH_NAME], capture_output=True, text=True)
+        result = _run(["git", "ls-remote", "--heads", "origin", BRANCH_NAME], capture=True)
         if result.stdout.strip():
             print(f"Reusing existing branch: {BRANCH_NAME}")
-            subprocess.run(["git", "fetch", "origin", BRANCH_NAME])
-            subprocess.run(["git", "checkout", BRANCH_NAME])
-            subprocess.run(["git", "pull", "origin", BRANCH_NAME])
+            _run(["git", "fetch", "origin", BRANCH_NAME])
+            _run(["git", "checkout", BRANCH_NAME])
+            _run(["git", "pull", "origin", BRANCH_NAME])
         else:
             print(f"Creating new branch: {BRANCH_NAME}")
-            subprocess.run(["git", "checkout", "-b", BRANCH_NAME])
+            _run(["git", "checkout", "-b", BRANCH_NAME])
         return True
 
 
-def summarize_long_file(file_path, content):
-    """Generate AI summary for the given file content"""
-    print(f"Generating summary for long file: {file_path}")
-    
-    prompt = f"""
-Analyze this documentation file and create a comprehensive summary that captures:
-
-1. **Primary Purpose**: What this file documents
-2. **Key Topics Covered**: Main sections, features, components discussed  
-3. **Technical Keywords**: Important terms, APIs, configuration options, commands
-4. **Target Audience**: Who would use this documentation
-5. **Related Concepts**: What other systems/features this relates to
-
-File: {file_path}
-Content:
-{content}
-
-Provide a detailed summary that would help an AI system understand when this file should be updated based on code changes.
-"""
-    
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt,
-        config=types.GenerateContentConfig(
-            thinking_config=types.ThinkingConfig(thinking_budget=0)
-        ),
-    )
-    
-    return response.text.strip()
+def estimate_tokens(text):
+    """Rough token estimate used to size prompts without a tokenizer round-trip"""
+    return len(text) // CHARS_PER_TOKEN
 
-def get_file_content_or_summaries(line_threshold=300):
-    """Get file content - full content for short files, AI summaries for long files"""
+def _iter_docs(root, prefix=""):
+    """Yield relative paths of .adoc and .md files in a single scandir walk"""
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                rel_path = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    # Prune whole subtrees that never contain project docs
+                    if entry.name not in IGNORED_DIRS:
+                        yield from _iter_docs(entry.path, rel_path + "/")
+                elif entry.name.endswith(DOC_EXTENSIONS):
+                    yield rel_path
+    except OSError as e:
+        print(f"Skipping directory {root}: {e}")
+
+def get_doc_files_content(max_file_tokens=MAX_BATCH_TOKENS):
+    """Get the full content of every documentation file, truncating pathological ones"""
     file_data = []
-    # Look for both .adoc and .md documentation files
-    doc_files = []
-    doc_files.extend(list(Path(".").rglob("*.adoc")))
-    doc_files.extend(list(Path(".").rglob("*.md")))
-    
-    for path in doc_files:
+    max_chars = max_file_tokens * CHARS_PER_TOKEN
+    for path in _iter_docs("."):
         try:
-            with open(path, encoding="utf-8") as f:
-                content = f.read()
-                
-            # Check file length and decide what to use
-            line_count = len(content.split('\n'))
-            
-            if line_count > line_threshold:
-                # Long file - generate summary
-                content_to_use = summarize_long_file(str(path), content)
-                print(f"Processed {path}: {line_count} lines (using AI summary)")
+            with open(path, "rb") as f:
+                data = f.read()
+
+            # Count lines on the raw bytes - no per-line list, no extra decoded copy
+            line_count = data.count(b"\n") + 1
+
+            if len(data) > max_chars:
+                # Too large for a single prompt - keep the head rather than summarizing,
+                # and only decode the part we keep
+                content = data[:max_chars].decode("utf-8", errors="ignore") + TRUNCATION_MARKER
+                print(f"Processed {path}: {line_count} lines (truncated to ~{max_file_tokens} tokens)")
             else:
-                # Short file - use full content
-                content_to_use = content
+                content = data.decode("utf-8")
                 print(f"Processed {path}: {line_count} lines (using full content)")
-            
-            file_data.append((str(path), content_to_use))
-            
+
+            file_data.append((path, content))
+
         except Exception as e:
             print(f"Skipping file {path}: {e}")
-    
+
     print(f"DEBUG: Returning {len(file_data)} files for processing")
     return file_data
 
-def ask_gemini_for_relevant_files(diff, file_previews):
-    all_relevant_files = []
-    batch_size = 10
-    
-    # Process files in batches of 10
-    for i in range(0, len(file_previews), batch_size):
-        batch = file_previews[i:i + batch_size]
-        batch_num = (i // batch_size) + 1
-        total_batches = (len(file_previews) + batch_size - 1) // batch_size
-        
-        print(f"Processing batch {batch_num}/{total_batches} ({len(batch)} files)...")
-        
-        # Create context for this batch of 10 files
-        context = "\n\n".join(
-            [f"File: {fname}\nPreview:\n{preview}" for fname, preview in batch]
+def pack_batches(file_contents, token_budget):
+    """Greedily pack files, smallest first, into batches that fit the token budget"""
+    batches = []
+    current = []
+    current_tokens = 0
+
+    for fname, content in sorted(file_contents, key=lambda item: len(item[1])):
+        tokens = estimate_tokens(content)
+        if current and current_tokens + tokens > token_budget:
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((fname, content))
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+    return batches
+
+async def with_retries(call, label):
+    """Await call(), retrying rate limits, server errors and network failures with backoff"""
+    for attempt in range(1, GEMINI_ATTEMPTS + 1):
+        try:
+            return await call()
+        except Exception as e:
+            code = e.code if isinstance(e, errors.APIError) else None
+            # Other 4xx errors (bad request, expired cache, ...) won't succeed on retry
+            retryable = code is None or code == 429 or code >= 500
+            if not retryable or attempt == GEMINI_ATTEMPTS:
+                raise
+            delay = RATE_LIMIT_BACKOFF_SECONDS * attempt if code == 429 else 2 ** attempt
+            print(f"{label}: Attempt {attempt} failed, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+
+async def generate_content(**kwargs):
+    """Call Gemini through the async client, capping the number of in-flight requests"""
+    async with gemini_semaphore:
+        return await client.aio.models.generate_content(**kwargs)
+
+def content_hash(*parts):
+    return hashlib.blake2b("\n".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+async def embed_texts(texts, task_type):
+    """Embed texts with the Gemini batch API, EMBEDDING_BATCH_SIZE texts per call"""
+    async def embed_batch(batch):
+        async with gemini_semaphore:
+            response = await client.aio.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=batch,
+                config=types.EmbedContentConfig(task_type=task_type),
+            )
+        return [embedding.values for embedding in response.embeddings]
+
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return np.array([values for batch in results for values in batch], dtype=np.float32)
+
+def prune_embedding_cache(keep):
+    """Delete cached embeddings not used by this run so the persisted cache can't grow forever"""
+    try:
+        stale = [path for path in EMBEDDING_CACHE_DIR.glob("*.npy") if path not in keep]
+    except OSError:
+        return
+    for path in stale:
+        try:
+            path.unlink()
+        except OSError as e:
+            print(f"Warning: Could not delete stale embedding {path.name}: {e}")
+    if stale:
+        print(f"Pruned {len(stale)} stale embeddings from the cache")
+
+async def embed_docs(file_contents):
+    """Embed doc files, reusing on-disk embeddings for content seen in earlier runs"""
+    texts = [f"File: {fname}\n{content[:EMBEDDING_MAX_CHARS]}" for fname, content in file_contents]
+    cache_paths = [EMBEDDING_CACHE_DIR / f"{content_hash(EMBEDDING_MODEL, text)}.npy" for text in texts]
+
+    embeddings = [None] * len(texts)
+    missing = []
+    for i, cache_path in enumerate(cache_paths):
+        try:
+            embeddings[i] = np.load(cache_path)
+        except (OSError, ValueError, EOFError):
+            missing.append(i)
+
+    print(f"Embedding {len(missing)} docs ({len(texts) - len(missing)} cached)")
+    if missing:
+        new_embeddings = await embed_texts([texts[i] for i in missing], "RETRIEVAL_DOCUMENT")
+        try:
+            EMBEDDING_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        except Exception as e:
+            print(f"Warning: Could not create embedding cache directory: {e}")
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+            try:
+                np.save(cache_paths[i], embedding)
+            except Exception as e:
+                print(f"Warning: Could not cache embedding for {file_contents[i][0]}: {e}")
+
+    prune_embedding_cache(set(cache_paths))
+    return np.stack(embeddings)
+
+async def filter_docs_by_similarity(diff, file_contents, threshold=SIMILARITY_THRESHOLD):
+    """Keep only docs whose embedding is close enough to some part of the diff"""
+    # Embed the diff in chunks so large PRs are not cut off at the model's input limit
+    diff_chunks = [diff[i:i + EMBEDDING_MAX_CHARS] for i in range(0, len(diff), EMBEDDING_MAX_CHARS)]
+
+    try:
+        diff_embeddings, doc_embeddings = await asyncio.gather(
+            embed_texts(diff_chunks, "RETRIEVAL_QUERY"),
+            embed_docs(file_contents),
+        )
+    except Exception as e:
+        print(f"Warning: Embedding pre-filter failed, keeping all docs: {e}")
+        return file_contents
+
+    # Cosine similarity of every doc against every diff chunk in a single matmul
+    doc_embeddings /= np.maximum(np.linalg.norm(doc_embeddings, axis=1, keepdims=True), 1e-12)
+    diff_embeddings /= np.maximum(np.linalg.norm(diff_embeddings, axis=1, keepdims=True), 1e-12)
+    similarities = (doc_embeddings @ diff_embeddings.T).max(axis=1)
+
+    kept = [item for item, similarity in zip(file_contents, similarities) if similarity >= threshold]
+    print(f"Embedding pre-filter kept {len(kept)}/{len(file_contents)} docs (threshold {threshold})")
+    return kept
+
+async def create_diff_cache(diff, model):
+    """Upload the PR diff once as cached context; returns the cache name or None"""
+    if estimate_tokens(diff) < MIN_CACHE_TOKENS:
+        print("Diff is too small for context caching, sending it inline")
+        return None
+
+    try:
+        cache = await client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                display_name="pr-diff",
+                contents=[f"A code change was made in this PR (Git diff):\n{diff}"],
+                ttl=DIFF_CACHE_TTL,
+            ),
         )
+        print(f"Cached PR diff for {model} as {cache.name}")
+        return cache.name
+    except Exception as e:
+        print(f"Warning: Could not create diff cache, sending diff inline: {e}")
+        return None
 
-        prompt = f"""
-        You are a VERY STRICT documentation assistant. You must select ONLY the ABSOLUTE MINIMUM files.
+async def delete_diff_cache(diff_cache):
+    if not diff_cache:
+        return
+    try:
+        await client.aio.caches.delete(name=diff_cache)
+    except Exception as e:
+        print(f"Warning: Could not delete diff cache {diff_cache}: {e}")
+
+def format_diff_for_prompt(diff, diff_cache):
+    """Return the diff text to embed in a prompt, or a pointer to the cached copy"""
+    if diff_cache:
+        return "(see the Git diff provided in the cached context above)"
+    return diff
+
+async def ask_gemini_for_relevant_batch(diff_summary, batch):
+    """Ask Gemini which files from a single batch of docs need updates"""
+    # Create context for this batch of files
+    context = "\n\n".join(
+        [f"File: {fname}\nContent:\n{content}" for fname, content in batch]
+    )
 
-        A code change was made in this PR (Git diff):
-        {diff}
+    prompt = f"""
+    You are a VERY STRICT documentation assistant. You must select ONLY the ABSOLUTE MINIMUM files.
 
-        Below is a list of documentation files (.adoc and .md) and their content:
+    A code change was made in this PR. These files were changed (with the headers of each changed hunk):
+    {diff_summary}
 
-        {context}
+    Below is a list of documentation files (.adoc and .md) and their content:
 
-        STRICT RULES - BE EXTREMELY CONSERVATIVE:
-        1. ONLY select command reference files if a command was added/modified
-        2. ONLY select feature-specific docs if that EXACT feature was changed
-        3. When in doubt, DO NOT select the file
+    {context}
 
-        Based on the diff, which files from this list should be updated? Return only the file paths (one per line). No explanations or extra formatting.
-        If no files need updates, return "NONE".
-        """
+    STRICT RULES - BE EXTREMELY CONSERVATIVE:
+    1. ONLY select command reference files if a command was added/modified
+    2. ONLY select feature-specific docs if that EXACT feature was changed
+    3. When in doubt, DO NOT select the file
 
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                thinking_config=types.ThinkingConfig(thinking_budget=0)
-            ),
+    Based on the diff, which files from this list are relevant? Return a JSON array with one entry per relevant file:
+    - "file": the file path exactly as listed above
+    - "confidence": how sure you are, from 0.0 to 1.0, that the file must be edited
+    - "likely_needs_edit": whether the file's content is now outdated or missing information
+    If no files are relevant, return an empty array.
+    """
+
+    response = await generate_content(
+        model=SELECTION_MODEL,
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            thinking_config=types.ThinkingConfig(thinking_budget=0),
+            response_mime_type="application/json",
+            response_schema=list[FileRelevance],
+        ),
+    )
+
+    if response.parsed is None:
+        raise ValueError(f"Could not parse relevance response: {response.text!r}")
+    return response.parsed
+
+async def ask_gemini_for_relevant_files(diff_summary, file_contents):
+    """Return {file path: FileRelevance} for docs Gemini expects to need an edit"""
+    all_relevant_files = {}
+
+    # Every batch repeats the diff summary, so only the remainder of the budget is for docs
+    token_budget = max(MAX_BATCH_TOKENS - estimate_tokens(diff_summary), MAX_BATCH_TOKENS // 4)
+    batches = pack_batches(file_contents, token_budget)
+    total_batches = len(batches)
+    print(f"Processing {len(file_contents)} files in {total_batches} batch(es)...")
+
+    # Batches are independent, so send them to Gemini concurrently. A dropped batch
+    # would silently exclude its docs, so retry and then fail the run
+    results = await asyncio.gather(*(
+        with_retries(
+            lambda batch=batch: ask_gemini_for_relevant_batch(diff_summary, batch),
+            f"Batch {batch_num}/{total_batches}",
         )
-        
-        result_text = response.text.strip()
-        if result_text.upper() == "NONE":
-            print(f"Batch {batch_num}: No relevant files found")
+        for batch_num, batch in enumerate(batches, start=1)
+    ))
+
+    for batch_num, suggested_files in enumerate(results, start=1):
+        if not suggested_files:
+            print(f"Batch {batch_num}/{total_batches}: No relevant files found")
             continue
-        
+
         # Filter out source code files - only keep documentation files (.adoc and .md)
-        suggested_files = [line.strip() for line in result_text.splitlines() if line.strip()]
-        filtered_files = [f for f in suggested_files if f.endswith('.adoc') or f.endswith('.md')]
-        
+        suggested_files = [item for item in suggested_files if item.file.strip()]
+        filtered_files = [item for item in suggested_files if item.file.strip().endswith(DOC_EXTENSIONS)]
+
         if len(filtered_files) != len(suggested_files):
-            skipped = [f for f in suggested_files if not (f.endswith('.adoc') or f.endswith('.md'))]
-            print(f"Batch {batch_num}: Skipping non-documentation files: {skipped}")
-        
-        all_relevant_files.extend(filtered_files)
-        print(f"Batch {batch_num}: Found {len(filtered_files)} relevant files")
-    
+            skipped = [item.file for item in suggested_files if not item.file.strip().endswith(DOC_EXTENSIONS)]
+            print(f"Batch {batch_num}/{total_batches}: Skipping non-documentation files: {skipped}")
+
+        # Files judged up to date need no second Gemini call at all
+        filtered_files = [item for item in filtered_files if item.likely_needs_edit]
+        for item in filtered_files:
+            all_relevant_files[item.file.strip()] = item
+        print(f"Batch {batch_num}/{total_batches}: Found {len(filtered_files)} relevant files")
+
     print(f"Total relevant files found: {len(all_relevant_files)}")
     return all_relevant_files
 
@@ -283,13 +533,7 @@ def load_full_content(file_path):
         print(f"Failed to read {file_path}: {e}")
         return ""
 
-def ask_gemini_for_updated_content(diff, file_path, current_content):
-    # Determine file format based on extension
-    is_markdown = file_path.endswith('.md')
-    is_asciidoc = file_path.endswith('.adoc')
-    
-    if is_markdown:
-        format_instructions = """
+_MARKDOWN_INSTRUCTIONS = """
 CRITICAL FORMATTING REQUIREMENTS FOR MARKDOWN FILES:
 **MOST IMPORTANT**: The output must be RAW MARKDOWN content that can be written DIRECTLY to a .md file.
 - NEVER wrap the output in code fences like ```markdown or ``` 
@@ -305,9 +549,8 @@ CRITICAL FORMATTING REQUIREMENTS FOR MARKDOWN FILES:
 - Use consistent indentation and spacing
 - Do NOT mix AsciiDoc syntax with Markdown
 """
-        format_name = "Markdown"
-    elif is_asciidoc:
-        format_instructions = """
+
+_ASCIIDOC_INSTRUCTIONS = """
 CRITICAL FORMATTING REQUIREMENTS FOR ASCIIDOC FILES:
 **MOST IMPORTANT**: The output must be RAW ASCIIDOC content that can be written DIRECTLY to a .adoc file.
 - NEVER wrap the output in code fences like ```adoc or ``` or ```asciidoc
@@ -321,31 +564,58 @@ CRITICAL FORMATTING REQUIREMENTS FOR ASCIIDOC FILES:
 - Maintain proper table structures with matching |=== opening and closing
 - Keep all cross-references (xref) intact and properly formatted
 """
-        format_name = "AsciiDoc"
-    else:
-        # Default to treating as text/markdown
-        format_instructions = """
+
+# Default to treating as text/markdown
+_DEFAULT_INSTRUCTIONS = """
 FORMATTING REQUIREMENTS:
 - Maintain the existing format and syntax of the file
 - Keep all links and references intact and properly formatted
 - Use consistent indentation and spacing
 """
-        format_name = "the existing format"
 
-    prompt = f"""
-You are a CONSERVATIVE documentation assistant. Only make changes if ABSOLUTELY necessary.
-
-{format_instructions}
-- Ensure consistent indentation and spacing
+NO_UPDATE_NEEDED = "NO_UPDATE_NEEDED"
+# Enough leading characters to spot the sentinel behind whitespace or backticks
+# The model sometimes wraps the sentinel in backticks, as the prompt does
+_SENTINEL_PADDING = " \t\r\n`"
+_SENTINEL_PADDING_RE = re.compile(f"[{re.escape(_SENTINEL_PADDING)}]*")
+
+def is_no_update(text):
+    """Check for the NO_UPDATE_NEEDED sentinel without copying a (possibly huge) response"""
+    # Skip any amount of leading padding by index rather than stripping the whole text
+    start = _SENTINEL_PADDING_RE.match(text).end()
+    return text.startswith(NO_UPDATE_NEEDED, start)
+
+# File extension -> (format instructions, format name used in the prompt)
+_INSTRUCTIONS_BY_EXT = {
+    ".md": (_MARKDOWN_INSTRUCTIONS, "Markdown"),
+    ".adoc": (_ASCIIDOC_INSTRUCTIONS, "AsciiDoc"),
+}
+_DEFAULT_FORMAT = (_DEFAULT_INSTRUCTIONS, "the existing format")
+
+async def _generate_updated_content(diff, file_path, current_content, diff_cache=None, require_update=False):
+    # Determine file format based on extension
+    format_instructions, format_name = _INSTRUCTIONS_BY_EXT.get(Path(file_path).suffix, _DEFAULT_FORMAT)
 
-A developer made the following code changes:
-{diff}
+    if require_update:
+        # The relevance step expects an edit, but it only saw file names and hunk
+        # headers - so the model must still be allowed to decline
+        decision = f"""
+This file has already been identified as likely missing information about these code changes,
+so an update is expected. Still verify that against the code changes shown above.
 
-Here is the full content of the current documentation file `{file_path}`:
---------------------
-{current_content}
---------------------
+IMPORTANT RULES:
+1. Only add information that is DIRECTLY related to the code changes shown
+2. DO NOT add tangential information just because it seems related
+3. DO NOT rewrite or restructure the file - only add/modify what's necessary
+4. Preserve all existing content, links, formatting, and structure
+5. If the code changes turn out not to affect this file, or it already covers them, return `NO_UPDATE_NEEDED`
 
+Return ONLY:
+- The complete updated file in valid {format_name} format, OR
+- `NO_UPDATE_NEEDED` (if the file doesn't actually need changes)
+"""
+    else:
+        decision = f"""
 IMPORTANT RULES:
 1. First, verify the file's purpose matches the code changes. If the file is about a completely different feature, return `NO_UPDATE_NEEDED`
 2. Check if the file already covers the code changes adequately. Most files don't need updates.
@@ -364,15 +634,88 @@ Return ONLY:
 - The complete updated file in valid {format_name} format (if changes are essential)
 """
 
+    prompt = f"""
+You are a CONSERVATIVE documentation assistant. Only make changes if ABSOLUTELY necessary.
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt,
-        config=types.GenerateContentConfig(
-            thinking_config=types.ThinkingConfig(thinking_budget=0)
-        ),
+{format_instructions}
+- Ensure consistent indentation and spacing
+
+A developer made the following code changes:
+{format_diff_for_prompt(diff, diff_cache)}
+
+Here is the full content of the current documentation file `{file_path}`:
+--------------------
+{current_content}
+--------------------
+{decision}"""
+
+
+    # Stream the response so the common NO_UPDATE_NEEDED answer returns at the
+    # first tokens instead of waiting for Gemini to finish generating
+    chunks = []
+    head = ""
+    decided = False
+    async with gemini_semaphore:
+        stream = await client.aio.models.generate_content_stream(
+            model=AUTHOR_MODEL,
+            contents=prompt,
+            config=types.GenerateContentConfig(
+                cached_content=diff_cache,
+                thinking_config=types.ThinkingConfig(thinking_budget=0)
+            ),
+        )
+        async for chunk in stream:
+            if not chunk.text:
+                continue
+            chunks.append(chunk.text)
+            if decided:
+                continue
+
+            # Only the first non-padding characters decide whether this is the sentinel
+            head = (head + chunk.text).lstrip(_SENTINEL_PADDING)[:len(NO_UPDATE_NEEDED)]
+            if head == NO_UPDATE_NEEDED:
+                await stream.aclose()
+                return None
+            if head and not NO_UPDATE_NEEDED.startswith(head):
+                decided = True
+
+    # An empty or padding-only reply carries no update either
+    if not head or is_no_update(head):
+        return None
+
+    # Drop leading blank lines without copying the whole response
+    chunks[0] = chunks[0].lstrip("\r\n")
+    return "".join(chunks)
+
+async def ask_gemini_for_updated_content(diff, file_path, current_content, diff_cache=None, require_update=False):
+    """Return Gemini's updated content for a doc, or None if no update is needed
+
+    Responses from identical earlier runs are reused from the update cache.
+    """
+    # Re-runs on the same commit send the exact same prompt, so replay the stored
+    # answer - including NO_UPDATE_NEEDED, which is the common case
+    mode = "write" if require_update else "review"
+    cache_path = UPDATE_CACHE_DIR / f"{content_hash(AUTHOR_MODEL, mode, diff, file_path, current_content)}.txt"
+
+    try:
+        updated = cache_path.read_text(encoding="utf-8")
+        print(f"Using cached Gemini response for {file_path}")
+        return None if is_no_update(updated) else updated
+    except (OSError, UnicodeDecodeError):
+        pass
+
+    updated = await with_retries(
+        lambda: _generate_updated_content(diff, file_path, current_content, diff_cache, require_update),
+        file_path,
     )
-    return response.text.strip()
+
+    try:
+        UPDATE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(NO_UPDATE_NEEDED if updated is None else updated, encoding="utf-8")
+    except Exception as e:
+        print(f"Warning: Could not cache Gemini response for {file_path}: {e}")
+
+    return updated
 
 def overwrite_file(file_path, new_content):
     try:
@@ -383,7 +726,11 @@ def overwrite_file(file_path, new_content):
         return False
 
 def push_and_open_pr(modified_files, commit_info=None):
-    subprocess.run(["git", "add"] + modified_files)
+    # Pipe the paths through stdin so large PRs never hit the argument length limit
+    _run(["git", "add", "--pathspec-from-file=-", "--pathspec-file-nul"], input="\0".join(modified_files))
+    if _run(["git", "diff", "--cached", "--quiet"], check=False).returncode == 0:
+        print("No documentation changes staged — no PR created.")
+        return
     
     # Build commit message with useful links
     commit_msg = "Auto-generated doc updates from code changes"
@@ -400,7 +747,7 @@ def push_and_open_pr(modified_files, commit_info=None):
     
     commit_msg += "\n\nAssisted-by: Gemini"
     
-    subprocess.run([
+    _run([
         "git", "commit",
         "-m", commit_msg
     ])
@@ -410,26 +757,30 @@ def push_and_open_pr(modified_files, commit_info=None):
     docs_repo_url = DOCS_REPO_URL.replace("https://", f"https://{gh_token}@")
 
     # Clear GitHub Actions default authentication that interferes with our PAT
-    subprocess.run(["git", "config", "--unset-all", "http.https://github.com/.extraheader"], 
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # (exits non-zero when the header is not set, which is fine)
+    _run(["git", "config", "--unset-all", "http.https://github.com/.extraheader"], check=False,
+         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     
-    subprocess.run(["git", "remote", "set-url", "origin", docs_repo_url])
-    subprocess.run(["git", "push", "--set-upstream", "origin", BRANCH_NAME, "--force"])
+    _run(["git", "remote", "set-url", "origin", docs_repo_url])
+    _run(["git", "push", "--set-upstream", "origin", BRANCH_NAME, "--force"])
 
     # Build PR body (simple, without commit references)
     pr_body = "This PR updates the following documentation files based on code changes:\n\n"
     pr_body += "\n".join([f"- `{f}`" for f in modified_files])
     pr_body += "\n\n*Note: Each commit in this PR contains references to the specific source code commits that triggered the documentation updates.*"
 
-    subprocess.run([
+    # A PR from a reused branch may already exist; the push above has updated it
+    result = _run([
         "gh", "pr", "create",
         "--title", "Auto-Generated Doc Updates from Code PR",
         "--body", pr_body,
         "--base", "master",
         "--head", BRANCH_NAME
-    ])
+    ], check=False)
+    if result.returncode != 0:
+        print(f"Warning: gh pr create exited with code {result.returncode}")
 
-def main():
+async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--dry-run", action="store_true", help="Simulate changes without writing files or pushing PR")
     args = parser.parse_args()
@@ -448,40 +799,95 @@ def main():
         print("Failed to set up docs environment")
         return
         
-    file_previews = get_file_content_or_summaries()
-    print(f"DEBUG: Collected {len(file_previews)} file previews")
+    file_contents = get_doc_files_content()
+    print(f"DEBUG: Collected {len(file_contents)} documentation files")
 
-    if not file_previews:
+    if not file_contents:
         print("No documentation files found to process.")
         return
 
+    file_contents = await filter_docs_by_similarity(diff, file_contents)
+    if not file_contents:
+        print("No documentation files are similar enough to the code changes.")
+        return
+
+    diff_by_file = split_diff_by_file(diff)
+
     print("Asking Gemini for relevant files...")
-    relevant_files = ask_gemini_for_relevant_files(diff, file_previews)
+    relevant_files = await ask_gemini_for_relevant_files(summarize_diff(diff_by_file), file_contents)
     if not relevant_files:
         print("Gemini did not suggest any files.")
         return
 
-    print("Files selected by Gemini:", relevant_files)
+    print("Files selected by Gemini:", list(relevant_files))
 
-    modified_files = []
-    for file_path in relevant_files:
+    # Narrow the diff sent with each doc to the source files that doc talks about
+    docs_to_check = []
+    for file_path, relevance in relevant_files.items():
         current = load_full_content(file_path)
-        if not current:
-            continue
+        if current:
+            doc_diff = select_diff_for_doc(diff, diff_by_file, current)
+            docs_to_check.append((file_path, current, doc_diff, relevance.confidence >= HIGH_CONFIDENCE))
 
-        print(f"Checking if {file_path} needs an update...")
-        updated = ask_gemini_for_updated_content(diff, file_path, current)
+    # Uploading the full diff as cached context only pays off when several docs reuse it
+    full_diff_docs = sum(doc[2] is diff for doc in docs_to_check)
+    author_cache = await create_diff_cache(diff, AUTHOR_MODEL) if full_diff_docs >= 2 else None
+    try:
+        async def check_and_update(file_path, current, doc_diff, require_update):
+            if require_update:
+                print(f"Checking {file_path} (high-confidence selection, update expected)...")
+            else:
+                print(f"Checking if {file_path} needs an update...")
+            diff_cache = author_cache if doc_diff is diff else None
+            try:
+                try:
+                    updated = await ask_gemini_for_updated_content(doc_diff, file_path, current, diff_cache, require_update)
+                except Exception as e:
+                    if diff_cache is None:
+                        raise
+                    # The cached diff may have expired (DIFF_CACHE_TTL) on a long run - resend it inline
+                    print(f"Warning: Cached diff failed for {file_path}, retrying with the diff inline: {e}")
+                    updated = await ask_gemini_for_updated_content(doc_diff, file_path, current, None, require_update)
+            except Exception as e:
+                # Don't let one doc's failure throw away every other doc's update
+                print(f"Warning: Skipping {file_path} after Gemini kept failing: {e}")
+                return file_path, None
+
+            if updated == current:
+                # Gemini echoed the file back unchanged - there is nothing to commit
+                updated = None
+            if updated is None:
+                print(f"No update needed for {file_path}")
+
+            return file_path, updated
+
+        # Each file is checked independently, so query Gemini concurrently and
+        # start writing each updated file as soon as its answer arrives
+        modified_files = []
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=4) as write_executor:
+            writes = []
+            for next_result in asyncio.as_completed([check_and_update(*doc) for doc in docs_to_check]):
+                file_path, updated = await next_result
+                if updated is None:
+                    continue
+
+                if args.dry_run:
+                    print(f"[Dry Run] Would update {file_path} with:\n{updated}\n")
+                else:
+                    print(f"Updating {file_path}...")
+                    # Every write targets a different file, so they can safely overlap
+                    write = loop.run_in_executor(write_executor, overwrite_file, file_path, updated)
+                    writes.append((file_path, write))
 
-        if updated.strip() == "NO_UPDATE_NEEDED":
-            print(f"No update needed for {file_path}")
-            continue
+            for file_path, write in writes:
+                if await write:
+                    modified_files.append(file_path)
+    finally:
+        await delete_diff_cache(author_cache)
 
-        if args.dry_run:
-            print(f"[Dry Run] Would update {file_path} with:\n{updated}\n")
-        else:
-            print(f"Updating {file_path}...")
-            if overwrite_file(file_path, updated):
-                modified_files.append(file_path)
+    # Keep the order Gemini selected the files in, not the order they finished
+    modified_files.sort(key=list(relevant_files).index)
 
     if modified_files:
         if args.dry_run:
@@ -518,7 +924,7 @@ def main():
                 # Go back to repo root for git operations
                 os.chdir("..")
                 # Create and switch to docs branch
-                subprocess.run(["git", "checkout", "-b", BRANCH_NAME])
+                _run(["git", "checkout", "-b", BRANCH_NAME])
                 # Convert file paths to include docs subfolder prefix
                 docs_files = [f"{docs_subfolder}/{f}" if not f.startswith(docs_subfolder) else f for f in modified_files]
                 push_and_open_pr(docs_files, commit_info)
@@ -529,4 +935,4 @@ def main():
         print("All documentation is already up to date — no PR created.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file